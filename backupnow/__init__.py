@@ -15,6 +15,7 @@ import logging
 import os
 import re
 import shutil
+import stat
 import sys
 
 from datetime import datetime
@@ -23,6 +24,13 @@ from logging import getLogger
 if sys.version_info.major >= 3:
     from datetime import timezone
 
+from backupnow.bncopy import CopyPool
+from backupnow.bnwalk import (
+    list_dir,
+    scan_dir,
+    walk_tree,
+)
+
 
 if __name__ == "__main__":
     MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -48,6 +56,8 @@ SEARCH_DIRS = [
 
 ALPHABET_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
+STATUS_INTERVAL = 1000  # Files to count between "Calculating" messages
+
 
 def best_utc_now():
     # type: () -> datetime
@@ -77,21 +87,31 @@ def formatted_ex(ex):
 
 
 def get_size(start_path, event_template=None, status_cb=None):
-    # based on <https://stackoverflow.com/a/1392549>
+    """Get the total size of the files in a directory tree.
+
+    Args:
+        start_path (str): The root of the tree.
+        event_template (dict, optional): Basis for the event sent to
+            status_cb. Defaults to None.
+        status_cb (Callable, optional): Function to call for progress,
+            accepting one arg which is event (dict) containing a
+            'message'. Defaults to None.
+
+    Returns:
+        int: The total size in bytes (symbolic links are skipped).
+    """
     total_size = 0
     event = {} if (event_template is None) else copy.deepcopy(event_template)
     num = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            num += 1
-            fp = os.path.join(dirpath, f)
-            # skip if it is symbolic link
-            if status_cb:
-                event['message'] = ("Calculating size of {} file(s) in {}"
-                                    .format(num, repr(start_path)))
-                status_cb(event)
-            if not os.path.islink(fp):
-                total_size += os.path.getsize(fp)
+    for record in walk_tree(start_path):
+        if not stat.S_ISREG(record.stat.st_mode):
+            continue  # skip directories and symbolic links
+        num += 1
+        if status_cb and (num % STATUS_INTERVAL == 0):
+            event['message'] = ("Calculating size of {} file(s) in {}"
+                                .format(num, repr(start_path)))
+            status_cb(event)
+        total_size += record.stat.st_size
 
     return total_size
 
@@ -135,17 +155,48 @@ def getRelPaths(path, sort=True, root=None):
     return results
 
 
+def _on_file_done(event, result, status_cb, manifest=None):
+    """Count a file as done and report it (See sync_dir).
+    This is the only place sync_dir changes the done counters, and it
+    always runs on the thread that called sync_dir.
+
+    Args:
+        event (dict): The event dict being updated by sync_dir.
+        result (dict): A CopyPool result (or equivalent dict for a
+            file that did not need to be copied) containing 'size' and
+            'src' (and 'error' if copying failed), and 'rel_path',
+            'mtime_ns' and 'inode' if manifest is set.
+        status_cb (Callable): See sync_dir.
+        manifest (Optional[Manifest]): If set, record the file.
+    """
+    error = result.get('error')
+    if error is not None:
+        raise error
+    if manifest is not None:
+        manifest.add(result['rel_path'], result['size'], result['mtime_ns'],
+                     result['inode'])
+    event['files_done'] += 1
+    event['bytes_done'] += result['size']
+    event['current_file_rel_path'] = result['src']
+    if status_cb is not None:
+        status_cb(event)
+
+
 def sync_dir(src, dst, excludes=None,
              event_template=None,
-             status_cb=None, rel=None,
-             dry_run=False, depth=0,
-             quiet=True):
+             status_cb=None,
+             dry_run=False,
+             quiet=True, workers=1, manifest=None):
     """Copy each file in source where there isn't a matching destination.
 
+    The source is walked once (See walk_tree), and each entry is only
+    stat'ed once. The same records provide the byte total and are used
+    for deciding what to copy. Each destination directory is listed
+    once (See scan_dir), and only entries with a matching source file
+    are stat'ed.
+
     Args:
         src (str): source path
-        depth (int): Leave this as the default (directory tree depth,
-            computed during recursion). Defaults to 0.
         dst (str): destination path
         excludes (Union[str,re.Pattern], optional): paths or regex
             patterns (checked against path relative to src) to exclude.
@@ -153,8 +204,6 @@ def sync_dir(src, dst, excludes=None,
         event_template (dict): Basis for creating
             the return dict. If None, return dict will only have
             values generated by the method.
-        rel (Optional[str]): Leave as None (relative path to source for
-            excludes, computed during recursion).
         status_cb (Callable): Function to call for progress,
             accepting one arg which is event (dict) containing one
             or more of (at least 'done' and event_template's keys):
@@ -162,6 +211,16 @@ def sync_dir(src, dst, excludes=None,
             - 'files_done' (int)
             - 'files_total' (int)
             - 'ratio' (float)
+        workers (int, optional): Number of files to copy at once. If
+            more than 1, the directory tree is still walked by the
+            calling thread, but copying is done by a pool of worker
+            threads (status_cb is still only called from the calling
+            thread). Defaults to 1.
+        manifest (Optional[bnmanifest.Manifest]): If set, a source file
+            that matches its record from a previous run is not compared
+            to the destination, and unchanged directories may not even
+            be listed (See Manifest). Every file found to be on the
+            destination is recorded. Ignored if dry_run is True.
     """
     def default_status_cb(d):
         print("[sync_dir default_status_cb] {}".format(d))
@@ -169,8 +228,8 @@ def sync_dir(src, dst, excludes=None,
         status_cb = default_status_cb
 
     event = {} if event_template is None else event_template
-    # ^ reference *NOT copy* in this case, for preserving
-    #   counts during recursion.
+    # ^ reference *NOT copy* in this case, so the caller's dict gets
+    #   the counts.
 
     if excludes is not None:
         if isinstance(excludes, list):
@@ -179,7 +238,7 @@ def sync_dir(src, dst, excludes=None,
         else:
             assert isinstance(excludes, (str, re.Pattern))
             excludes = [excludes]
-    src_subs = []
+        # NOTE: excludes are checked but not applied (as before).
     if 'files_done' not in event:
         event['files_done'] = 0
     if 'files_total' not in event:
@@ -188,93 +247,121 @@ def sync_dir(src, dst, excludes=None,
         event['bytes_done'] = 0
     if 'bytes_total' not in event:
         event['bytes_total'] = 0
+
+    if dry_run:
+        manifest = None
+    if manifest is not None:
+        manifest.check_destination(dst)
+    records = []  # type: list[tuple[str, int, int, int, int]]
+    # ^ (rel_path, st_mode, st_size, st_mtime_ns, st_ino) of each file or
+    #   link
+    for record in walk_tree(src, list_dir=(manifest.list_dir if manifest
+                                           else list_dir)):
+        mode = record.stat.st_mode
+        if stat.S_ISDIR(mode):
+            continue
+        if stat.S_ISREG(mode):
+            event['files_total'] += 1
+            event['bytes_total'] += record.stat.st_size
+            if event['files_total'] % STATUS_INTERVAL == 0:
+                event['message'] = (
+                    "Calculating size of {} file(s) in {}"
+                    .format(event['files_total'], repr(src)))
+                status_cb(event)
+                del event['message']
+        elif not stat.S_ISLNK(mode):
+            continue  # Skip sockets, FIFOs, etc.
+        records.append((record.rel_path, mode, record.stat.st_size,
+                        record.stat.st_mtime_ns, record.stat.st_ino))
     if 'last_bytes_total' not in event:
-        assert depth == 0, "last_bytes_total was not calculated at top level."
-        event['last_bytes_total'] = get_size(
-            src,
-            event_template=event,
-            status_cb=status_cb,
-        )
+        event['last_bytes_total'] = event['bytes_total']
         # ^ saved at end of last job. See operation['last_bytes_total']
         event['save_operation_values'] = ['last_bytes_total']
         status_cb(event)
         del event['save_operation_values']
 
-    for sub in os.listdir(src):
-        src_sub_path = os.path.join(src, sub)
-        sub_rel = os.path.join(rel, sub) if rel else sub
-        if excludes is not None:
-            for exclude in excludes:
-                if isinstance(exclude, str):
-                    if sub_rel == exclude:
-                        continue
-                else:
-                    if exclude.match(sub):
-                        continue
-        src_subs.append(sub)
-        if os.path.isfile(src_sub_path):
-            event['files_total'] += 1
-            event['bytes_total'] += os.path.getsize(src_sub_path)
-
-    # print("rsync -a {}/ {}  # excludes={} rel={}"
-    #       .format(repr(src), repr(dst), repr(excludes), repr(rel)))
-    made_dst = False
-    for sub in src_subs:
-        src_sub_path = os.path.join(src, sub)
-        dst_sub_path = os.path.join(dst, sub)
-        sub_rel = os.path.join(rel, sub) if rel else sub
-        # if os.path.islink(src_sub_path):
-        if os.path.islink(src_sub_path):
-            # Copy even if dangling
-            if not quiet:
-                print("ln -s `readlink {}` {}".format(repr(src_sub_path),
-                                                      repr(dst_sub_path)))
-            if not dry_run:
-                shutil.copy2(src_sub_path, dst_sub_path)
-            continue
-        if os.path.isdir(src_sub_path):
-            sync_dir(
-                src_sub_path,
-                dst_sub_path,
-                excludes=excludes,
-                event_template=event,
-                status_cb=status_cb,
-                rel=sub_rel,
-                depth=depth+1,
-                dry_run=dry_run,
-                quiet=quiet,
-            )
-            continue
-        elif os.path.isfile(src_sub_path):
-            same = False
-            if os.path.isfile(dst_sub_path):
-                if (os.path.getmtime(dst_sub_path)
-                        == os.path.getmtime(src_sub_path)):
-                    if (os.path.getsize(dst_sub_path)
-                            == os.path.getsize(src_sub_path)):
-                        same = True
-            if not same:
-                if not os.path.isdir(dst):
+    # print("rsync -a {}/ {}  # excludes={}"
+    #       .format(repr(src), repr(dst), repr(excludes)))
+    pool = CopyPool(workers=workers)
+    dst_dir = None  # type: str|None
+    dst_entries = {}  # type: dict[str, os.DirEntry]
+    known_dir = None  # type: str|None
+    known_files = {}  # type: dict[str, tuple[int, int, int]]
+    complete = False
+    try:
+        for rel_path, mode, size, mtime_ns, inode in records:
+            src_sub_path = os.path.join(src, rel_path)
+            dst_sub_path = os.path.join(dst, rel_path)
+            info = {
+                'src': src_sub_path,
+                'rel_path': rel_path,
+                'size': size,
+                'mtime_ns': mtime_ns,
+                'inode': inode,
+            }
+            if (manifest is not None) and not stat.S_ISLNK(mode):
+                rel_parent, name = os.path.split(rel_path)
+                if rel_parent != known_dir:
+                    known_dir = rel_parent
+                    known_files = manifest.files_in(rel_parent)
+                if manifest.matches(known_files.get(name), size, mtime_ns,
+                                    inode):
+                    _on_file_done(event, info, status_cb)
+                    continue
+            parent = os.path.dirname(dst_sub_path)
+            if parent != dst_dir:
+                # Files in each directory are contiguous (See walk_tree)
+                dst_dir = parent
+                dst_entries = scan_dir(parent)
+                if not dst_entries and not os.path.isdir(parent):
+                    if not quiet:
+                        print("mkdir -p {}".format(repr(parent)))
                     if not dry_run:
-                        os.makedirs(dst)
-                    if not made_dst:
-                        if not quiet:
-                            print("mkdir -p {}".format(repr(dst)))
-                        made_dst = True
+                        os.makedirs(parent)
+            if stat.S_ISLNK(mode):
+                # Copy even if dangling
+                if not quiet:
+                    print("ln -s `readlink {}` {}"
+                          .format(repr(src_sub_path), repr(dst_sub_path)))
                 if not dry_run:
                     shutil.copy2(src_sub_path, dst_sub_path)
+                continue
+            same = False
+            dst_entry = dst_entries.get(os.path.basename(rel_path))
+            if dst_entry is not None:
+                dst_stat = dst_entry.stat(follow_symlinks=False)
+                if (stat.S_ISREG(dst_stat.st_mode)
+                        and (dst_stat.st_mtime_ns == mtime_ns)
+                        and (dst_stat.st_size == size)):
+                    same = True
+            if not same:
                 if not quiet:
                     print("cp -a {} {}".format(repr(src_sub_path),
                                                repr(dst_sub_path)))
-            event['files_done'] += 1
-            event['bytes_done'] += os.path.getsize(src_sub_path)
-            event['current_file_rel_path'] = src_sub_path
-            if status_cb is not None:
-                status_cb(event)
-    if depth == 0:
-        event['last_files_total'] = event['files_total']
-        event['save_operation_values'] = ['last_files_total']
-        status_cb(event)
-        del event['save_operation_values']
+                if not dry_run:
+                    if pool.full():
+                        for result in pool.poll(block=True):
+                            _on_file_done(event, result, status_cb,
+                                          manifest=manifest)
+                    pool.submit(src_sub_path, dst_sub_path, info)
+                    for result in pool.poll():
+                        _on_file_done(event, result, status_cb,
+                                      manifest=manifest)
+                    continue
+            _on_file_done(event, info, status_cb, manifest=manifest)
+        for result in pool.drain():
+            _on_file_done(event, result, status_cb, manifest=manifest)
+        complete = True
+    finally:
+        pool.close()
+        if manifest is not None:
+            if complete and os.path.isdir(dst):
+                manifest.set_destination_identity(dst)
+            manifest.save(complete=complete)
+            event['manifest_skipped_dirs'] = manifest.skipped_dirs
+    event['last_files_total'] = event['files_total']
+    event['save_operation_values'] = ['last_files_total']
+    status_cb(event)
+    del event['save_operation_values']
 
     return event
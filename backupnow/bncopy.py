@@ -0,0 +1,150 @@
+"""
+Copy files for sync_dir, optionally on a bounded pool of worker threads.
+
+This module only depends on the standard library so that the backupnow
+package can import it while the package itself is still initializing.
+"""
+from __future__ import print_function
+
+import shutil
+import threading
+
+from logging import getLogger
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # type: ignore
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None  # Python 2 without the futures backport
+
+logger = getLogger(__name__)
+
+
+class CopyPool:
+    """Copy files on worker threads but collect results on one thread.
+
+    The caller (such as sync_dir) keeps walking directories on its own
+    thread, calls submit for each file that needs to be copied, then
+    calls poll to collect results. That way only the caller's thread
+    changes counters (such as in the event dict) and calls status_cb.
+
+    Each result is the dict passed to submit with these keys added:
+    - 'src' (str): The source path.
+    - 'dst' (str): The destination path.
+    - 'error' (Exception|None): The exception raised while copying, if
+      any.
+
+    Args:
+        workers (int, optional): Number of copies that can run at once.
+            If 1 or less (or concurrent.futures is not available), each
+            copy runs synchronously during submit. Defaults to 1.
+        copy_fn (Callable, optional): Function that accepts src and dst
+            and copies a single file. Defaults to shutil.copy2.
+        max_pending (int, optional): Maximum number of copies that may
+            be submitted but not collected yet (See full). Defaults to
+            4 times workers.
+    """
+    def __init__(self, workers=1, copy_fn=None, max_pending=None):
+        if workers is None:
+            workers = 1
+        if not isinstance(workers, int):
+            raise TypeError("Expected int for workers, got {}({})"
+                            .format(type(workers).__name__, repr(workers)))
+        if copy_fn is None:
+            copy_fn = shutil.copy2
+        self.copy_fn = copy_fn
+        self.workers = max(workers, 1)
+        if max_pending is None:
+            max_pending = self.workers * 4
+        self.max_pending = max(max_pending, 1)
+        self.pending = 0
+        self._results = queue.Queue()
+        self._executor = None
+        if (self.workers > 1) and (ThreadPoolExecutor is not None):
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        elif self.workers > 1:
+            logger.warning("concurrent.futures is not available,"
+                           " so copying will not be parallel.")
+            self.workers = 1
+        self._lock = threading.Lock()
+
+    @property
+    def parallel(self):
+        return self._executor is not None
+
+    def _copy(self, src, dst, info):
+        result = info
+        result['src'] = src
+        result['dst'] = dst
+        result['error'] = None
+        try:
+            self.copy_fn(src, dst)
+        except Exception as ex:
+            result['error'] = ex
+        self._results.put(result)
+
+    def submit(self, src, dst, info=None):
+        """Copy a file (synchronously if not parallel).
+
+        Args:
+            src (str): Source file path.
+            dst (str): Destination file path (parent must exist).
+            info (dict, optional): Extra information to include in the
+                result, such as 'size'. Defaults to None.
+        """
+        if info is None:
+            info = {}
+        with self._lock:
+            self.pending += 1
+        if self._executor is None:
+            self._copy(src, dst, info)
+            return
+        self._executor.submit(self._copy, src, dst, info)
+
+    def full(self):
+        """Check whether the caller should collect results before
+        submitting more (poll with block=True to wait for room).
+        """
+        return self.pending >= self.max_pending
+
+    def poll(self, block=False):
+        """Collect results of finished copies.
+
+        Args:
+            block (bool, optional): Wait for at least one result if
+                any copy is pending. Defaults to False.
+
+        Yields:
+            dict: The result of each finished copy (See CopyPool).
+        """
+        while self.pending > 0:
+            try:
+                result = self._results.get(block=block)
+            except queue.Empty:
+                break
+            block = False  # Only wait for the first one.
+            with self._lock:
+                self.pending -= 1
+            yield result
+
+    def drain(self):
+        """Collect results until every submitted copy is finished.
+
+        Yields:
+            dict: The result of each finished copy (See CopyPool).
+        """
+        while self.pending > 0:
+            for result in self.poll(block=True):
+                yield result
+
+    def close(self):
+        """Wait for the worker threads to stop (results not collected
+        by drain or poll are discarded).
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
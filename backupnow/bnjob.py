@@ -7,6 +7,7 @@ import time
 
 from backupnow.bnlogging import emit_cast
 from backupnow import sync_dir
+from backupnow.bnmanifest import Manifest
 from backupnow.moresmb import get_mounted_share, split_share
 
 
@@ -29,6 +30,14 @@ class BNJob:
                 - "detect_destination_folder": Example: "3D Models",
                 - "detect_source_folder": "Design and Development",
                 - "source": "\\\\DATACENTER\\3D Models"
+                - "workers": Number of files to copy at once (optional,
+                  defaults to 1, See sync_dir).
+                - "manifest": Remember copied files between runs so
+                  unchanged files are not compared to the destination
+                  (optional, defaults to False, See Manifest).
+                - "skip_unchanged_dirs": Also skip listing source
+                  directories whose mtime is unchanged (optional,
+                  requires "manifest", defaults to False).
             require_subdirectory (bool): Require a subdirectory
                 to be specified to be either required via
                 operation['detect_destination_folder'] or created (via
@@ -175,12 +184,26 @@ class BNJob:
         results['valid_source'] = True
         if 'last_bytes_total' in operation:
             results['last_bytes_total'] = operation['last_bytes_total']
-        results = sync_dir(
-            src_path,
-            dst_path,
-            event_template=results,
-            status_cb=status_cb,
-        )  # excludes=None, exclude_res=None)
+        manifest = None
+        if operation.get('manifest'):
+            manifest = Manifest.for_operation(
+                src_path,
+                dst_path,
+                skip_unchanged_dirs=bool(
+                    operation.get('skip_unchanged_dirs')),
+            )
+        try:
+            results = sync_dir(
+                src_path,
+                dst_path,
+                event_template=results,
+                status_cb=status_cb,
+                workers=operation.get('workers', 1),
+                manifest=manifest,
+            )  # excludes=None, exclude_res=None)
+        finally:
+            if manifest is not None:
+                manifest.close()
         if results.get('bytes_total'):
             operation['last_bytes_total'] = results['bytes_total']
         results['done'] = True
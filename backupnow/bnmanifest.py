@@ -0,0 +1,283 @@
+"""
+Remember what sync_dir already copied so the next run of the same
+operation can skip work.
+
+The manifest for each source and destination pair is a SQLite database
+under the cache folder (See bnsysdirs.cache_path).
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import sqlite3
+import stat
+
+from collections import namedtuple
+from logging import getLogger
+
+from backupnow.bnsysdirs import cache_path
+from backupnow.bnwalk import list_dir
+
+logger = getLogger(__name__)
+
+ManifestStat = namedtuple(
+    'ManifestStat',
+    ['st_mode', 'st_size', 'st_mtime_ns', 'st_ino'],
+)
+"""Stand-in for os.stat_result for a file known from the manifest."""
+
+
+class Manifest:
+    """Record path, size, mtime_ns and inode of each source file copied
+    (or found to be already up to date) by sync_dir, and the mtime_ns of
+    each source directory.
+
+    On the next run, a source file that matches its record is not
+    compared to the destination at all. If skip_unchanged_dirs is True,
+    a source directory whose mtime matches its record (no entries were
+    added, removed or renamed in it) is not even listed: the files
+    recorded for it are used instead, and only its subdirectories are
+    stat'ed. That makes an incremental run scale with the number of
+    changed directories rather than the number of files, but a file
+    modified in place without changing its directory's mtime is only
+    noticed once the directory changes (or skip_unchanged_dirs is
+    False).
+
+    Args:
+        path (str): The database file.
+        skip_unchanged_dirs (bool, optional): See above. Defaults to
+            False.
+
+    Attributes:
+        skipped_dirs (int): Number of directories not listed during the
+            current run (See list_dir).
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, skip_unchanged_dirs=False):
+        self.path = path
+        self.skip_unchanged_dirs = skip_unchanged_dirs
+        self.skipped_dirs = 0
+        self._pending = []  # type: list[tuple[str, str, int, int, int]]
+        self._dir_mtimes = {}  # type: dict[str, int]
+        self._files_in = (None, {})  # type: tuple[str|None, dict]
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                PRIMARY KEY (parent, name)
+            );
+            CREATE TABLE IF NOT EXISTS dirs (
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                PRIMARY KEY (parent, name)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+    @classmethod
+    def for_operation(cls, src, dst, **kwargs):
+        """Open the manifest for a source and destination pair.
+
+        Args:
+            src (str): Source path (as passed to sync_dir).
+            dst (str): Destination path (as passed to sync_dir).
+            kwargs: Passed to the Manifest constructor.
+
+        Returns:
+            Manifest: The manifest (created if it did not exist).
+        """
+        key = hashlib.sha1(
+            (os.path.abspath(src) + "\0" + os.path.abspath(dst))
+            .encode('utf-8')
+        ).hexdigest()
+        manifests_dir = cache_path("manifests")
+        if not os.path.isdir(manifests_dir):
+            os.makedirs(manifests_dir)
+        return cls(os.path.join(manifests_dir, key + ".sqlite3"), **kwargs)
+
+    def check_destination(self, dst):
+        """Forget everything if the destination is not the same one
+        (such as if it was deleted and re-created, or is a different
+        drive mounted at the same path), since every record assumes the
+        destination still has the file.
+
+        Args:
+            dst (str): Destination path (as passed to sync_dir).
+        """
+        if not os.path.isdir(dst):
+            identity = None
+        else:
+            dst_stat = os.stat(dst)
+            identity = "{}:{}".format(dst_stat.st_dev, dst_stat.st_ino)
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'destination'").fetchone()
+        if (row is not None) and (row[0] == identity) and identity:
+            return
+        if row is not None:
+            logger.warning("Destination {} changed, so manifest {} was reset."
+                           .format(repr(dst), repr(self.path)))
+        self.clear()
+        if identity:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('destination', ?)",
+                (identity,))
+            self._conn.commit()
+
+    def set_destination_identity(self, dst):
+        """Store the identity of a destination created during the run
+        (See check_destination).
+        """
+        dst_stat = os.stat(dst)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('destination', ?)",
+            ("{}:{}".format(dst_stat.st_dev, dst_stat.st_ino),))
+
+    def clear(self):
+        self._files_in = (None, {})
+        del self._pending[:]
+        self._conn.execute("DELETE FROM files")
+        self._conn.execute("DELETE FROM dirs")
+        self._conn.execute("DELETE FROM meta")
+        self._conn.commit()
+
+    def files_in(self, rel_dir):
+        """Get the records of the files in one directory.
+
+        Args:
+            rel_dir (str): Directory relative to the source ("" for the
+                source itself).
+
+        Returns:
+            dict[str, tuple[int, int, int]]: (size, mtime_ns, inode) by
+                file name.
+        """
+        if self._files_in[0] == rel_dir:
+            return self._files_in[1]
+        self._flush()
+        records = {
+            row[0]: row[1:] for row in self._conn.execute(
+                "SELECT name, size, mtime_ns, inode FROM files"
+                " WHERE parent = ?", (rel_dir,))
+        }
+        self._files_in = (rel_dir, records)
+        # ^ walk_tree yields the files of a directory right after
+        #   listing it, so caching one directory avoids a second query.
+        return records
+
+    def list_dir(self, rel_dir, path, dir_stat=None):
+        """List a directory for walk_tree (See bnwalk.list_dir).
+        If skip_unchanged_dirs is True and the directory's mtime is
+        unchanged, list it using the manifest instead of the filesystem.
+        """
+        if dir_stat is None:
+            dir_stat = os.stat(path)
+        mtime_ns = dir_stat.st_mtime_ns
+        if self.skip_unchanged_dirs:
+            parent, name = os.path.split(rel_dir)
+            row = self._conn.execute(
+                "SELECT mtime_ns FROM dirs WHERE parent = ? AND name = ?",
+                (parent, name)).fetchone()
+            if (row is not None) and (row[0] == mtime_ns):
+                entries = []
+                for name, (size, file_mtime_ns, inode) in \
+                        self.files_in(rel_dir).items():
+                    entries.append((
+                        name,
+                        os.path.join(path, name),
+                        ManifestStat(stat.S_IFREG, size, file_mtime_ns,
+                                     inode),
+                    ))
+                for (name,) in self._conn.execute(
+                        "SELECT name FROM dirs WHERE parent = ?",
+                        (rel_dir,)).fetchall():
+                    sub_path = os.path.join(path, name)
+                    try:
+                        entries.append((name, sub_path, os.lstat(sub_path)))
+                    except FileNotFoundError:
+                        pass  # removed (so this dir's mtime is wrong)
+                self._dir_mtimes[rel_dir] = mtime_ns
+                self.skipped_dirs += 1
+                return entries
+        entries = list_dir(rel_dir, path, dir_stat)
+        # Forget entries that were removed from the source:
+        names = set(entry[0] for entry in entries)
+        known = self.files_in(rel_dir)
+        self._conn.executemany(
+            "DELETE FROM files WHERE parent = ? AND name = ?",
+            [(rel_dir, name) for name in known if name not in names])
+        self._conn.executemany(
+            "DELETE FROM dirs WHERE parent = ? AND name = ?",
+            [(rel_dir, name) for (name,) in self._conn.execute(
+                "SELECT name FROM dirs WHERE parent = ?",
+                (rel_dir,)).fetchall() if name not in names])
+        self._dir_mtimes[rel_dir] = mtime_ns
+        # ^ Only saved by save(complete=True), since a directory's mtime
+        #   should only be trusted if every file in it was synced.
+        return entries
+
+    def add(self, rel_path, size, mtime_ns, inode):
+        """Record a source file that is on the destination.
+
+        Args:
+            rel_path (str): Path relative to the source.
+            size (int): Size of the source file.
+            mtime_ns (int): st_mtime_ns of the source file.
+            inode (int): st_ino of the source file (0 if unknown).
+        """
+        parent, name = os.path.split(rel_path)
+        self._pending.append((parent, name, size, mtime_ns, inode))
+        if self._files_in[0] == parent:
+            self._files_in = (None, {})
+        if len(self._pending) >= Manifest.BATCH_SIZE:
+            self._flush()
+
+    def matches(self, record, size, mtime_ns, inode):
+        """Check if a file matches its record from files_in.
+
+        Args:
+            record (Optional[tuple[int, int, int]]): (size, mtime_ns,
+                inode) or None if there is no record.
+        """
+        if record is None:
+            return False
+        return ((record[0] == size) and (record[1] == mtime_ns)
+                and ((record[2] == inode) or not record[2] or not inode))
+
+    def _flush(self):
+        if self._pending:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                self._pending)
+            del self._pending[:]
+
+    def save(self, complete=True):
+        """Write pending records.
+
+        Args:
+            complete (bool, optional): Set to False if the run stopped
+                early, so directory mtimes are not saved (otherwise a
+                directory where some files were not copied could be
+                skipped next time). Defaults to True.
+        """
+        self._flush()
+        if complete:
+            rows = []
+            for rel_dir, mtime_ns in self._dir_mtimes.items():
+                parent, name = os.path.split(rel_dir)
+                rows.append((parent, name, mtime_ns))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", rows)
+        self._dir_mtimes.clear()
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,105 @@
+"""
+Walk a directory tree once, using os.scandir so that each entry is
+stat'ed at most once.
+
+This module only depends on the standard library so that the backupnow
+package can import it while the package itself is still initializing.
+"""
+from __future__ import print_function
+
+import os
+import stat
+
+from collections import namedtuple
+
+WalkRecord = namedtuple('WalkRecord', ['rel_path', 'path', 'stat'])
+"""One entry found by walk_tree.
+
+Attributes:
+    rel_path (str): Path relative to the root of the walk.
+    path (str): Full path (root joined with rel_path).
+    stat (os.stat_result): The result of lstat (symlinks are not
+        followed), cached by os.DirEntry so it is only stat'ed once.
+"""
+
+
+def scan_dir(path):
+    """List a directory without stat'ing every entry.
+
+    Args:
+        path (str): Any directory.
+
+    Returns:
+        dict[str, os.DirEntry]: Entries by name (empty if path does
+            not exist). Call entry.stat(follow_symlinks=False) only for
+            entries where the stat is needed (the result is cached).
+    """
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        return {}
+
+
+def list_dir(rel_dir, path, dir_stat=None):
+    """List a directory for walk_tree, stat'ing each entry once.
+
+    Args:
+        rel_dir (str): Path relative to the root of the walk ("" for
+            the root).
+        path (str): Full path of the directory.
+        dir_stat (os.stat_result, optional): The lstat of the directory
+            (None for the root). Not used here, but a replacement for
+            this function may use it (See walk_tree).
+
+    Returns:
+        list[tuple[str, str, os.stat_result]]: name, full path and
+            lstat of each entry.
+    """
+    with os.scandir(path) as it:
+        return [(entry.name, entry.path, entry.stat(follow_symlinks=False))
+                for entry in it]
+
+
+def walk_tree(root, list_dir=list_dir):
+    """Walk a tree in a deterministic order (sorted by name).
+
+    Each directory's record is yielded before its contents. Within a
+    directory, the files (and anything else that is not a directory)
+    are yielded before descending into the subdirectories, so that
+    the files of any one directory are always contiguous.
+
+    Symlinks to directories are yielded but not followed.
+
+    Args:
+        root (str): The directory to walk.
+        list_dir (Callable, optional): A function with the same
+            arguments and return as list_dir, such as to get the
+            entries of a directory known to be unchanged from somewhere
+            other than the filesystem (only the st_mode, st_size,
+            st_mtime_ns and st_ino attributes of each stat are
+            required). Defaults to list_dir.
+
+    Yields:
+        WalkRecord: An entry (See WalkRecord). The root itself is not
+            yielded.
+    """
+    stack = [None]  # None is the root (which is not yielded)
+    while stack:
+        dir_record = stack.pop()
+        if dir_record is None:
+            rel_dir, path = "", root
+        else:
+            yield dir_record
+            rel_dir, path = dir_record.rel_path, dir_record.path
+        dir_stat = None if dir_record is None else dir_record.stat
+        entries = sorted(list_dir(rel_dir, path, dir_stat))
+        sub_dirs = []
+        for name, sub_path, entry_stat in entries:
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            if stat.S_ISDIR(entry_stat.st_mode):
+                sub_dirs.append(WalkRecord(rel_path, sub_path, entry_stat))
+                continue
+            yield WalkRecord(rel_path, sub_path, entry_stat)
+        stack.extend(reversed(sub_dirs))
+        # ^ reversed so the first one (by name) is popped first.
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark sync_dir on a synthetic tree of small files.
+
+Example:
+    python3 benchmarks/bench_sync_dir.py --files 100000 --workers 1 8
+
+Each run copies into a new empty destination, so the time includes
+creating every file. Use --latency to simulate a slow (such as network)
+destination, where copying in parallel helps the most.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from backupnow import sync_dir  # noqa: E402
+
+
+def make_tree(root, files, per_dir=1000, size=512):
+    data = os.urandom(size)
+    for i in range(files):
+        sub = os.path.join(root, "d{:05d}".format(i // per_dir))
+        if i % per_dir == 0:
+            os.makedirs(sub)
+        with open(os.path.join(sub, "f{:07d}.bin".format(i)), 'wb') as f:
+            f.write(data)
+
+
+def slow_copy_fn(latency, copy_fn):
+    def slow_copy(src, dst):
+        time.sleep(latency)
+        return copy_fn(src, dst)
+    return slow_copy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=512,
+                        help="Bytes per file.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds to add to each copy.")
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp(prefix="bench_sync_dir-")
+    try:
+        src = os.path.join(tmp, "src")
+        print("Creating {} file(s) in {}...".format(args.files, src))
+        make_tree(src, args.files, size=args.size)
+        if args.latency:
+            shutil.copy2 = slow_copy_fn(args.latency, shutil.copy2)
+        for workers in args.workers:
+            dst = os.path.join(tmp, "dst-{}".format(workers))
+            start = time.time()
+            event = sync_dir(src, dst, status_cb=lambda evt: None,
+                             workers=workers)
+            elapsed = time.time() - start
+            print("workers={}: {} file(s) in {:.2f}s ({:.0f} files/s)"
+                  .format(workers, event['files_done'], elapsed,
+                          event['files_done'] / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
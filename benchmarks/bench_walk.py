@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compare stat calls and time of sync_dir's single-pass walk to the
+previous approach (get_size, then os.listdir with isfile, islink, isdir,
+getsize and getmtime for each entry of the source and destination).
+
+Example:
+    python3 benchmarks/bench_walk.py --files 100000
+
+Both are run on a destination that is already up to date, so nothing is
+copied and only the cost of deciding what to copy is measured.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from backupnow import sync_dir  # noqa: E402
+
+from bench_sync_dir import make_tree  # noqa: E402
+
+
+class StatCounter:
+    """Count calls to os.stat and os.lstat (used by os.path functions).
+    os.DirEntry.stat does not call them, so the walk_tree count is
+    the number of records instead (one lstat each).
+    """
+    def __init__(self):
+        self.count = 0
+        self._stat = os.stat
+        self._lstat = os.lstat
+
+    def __enter__(self):
+        def counted_stat(*args, **kwargs):
+            self.count += 1
+            return self._stat(*args, **kwargs)
+
+        def counted_lstat(*args, **kwargs):
+            self.count += 1
+            return self._lstat(*args, **kwargs)
+        os.stat = counted_stat
+        os.lstat = counted_lstat
+        return self
+
+    def __exit__(self, *args):
+        os.stat = self._stat
+        os.lstat = self._lstat
+
+
+def legacy_size(start_path):
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(start_path):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            if not os.path.islink(fp):
+                total_size += os.path.getsize(fp)
+    return total_size
+
+
+def legacy_scan(src, dst):
+    """Check every file the way sync_dir did before walk_tree."""
+    subs = []
+    for sub in os.listdir(src):
+        src_sub_path = os.path.join(src, sub)
+        subs.append(sub)
+        if os.path.isfile(src_sub_path):
+            os.path.getsize(src_sub_path)
+    for sub in subs:
+        src_sub_path = os.path.join(src, sub)
+        dst_sub_path = os.path.join(dst, sub)
+        if os.path.islink(src_sub_path):
+            continue
+        if os.path.isdir(src_sub_path):
+            legacy_scan(src_sub_path, dst_sub_path)
+            continue
+        elif os.path.isfile(src_sub_path):
+            if os.path.isfile(dst_sub_path):
+                if (os.path.getmtime(dst_sub_path)
+                        == os.path.getmtime(src_sub_path)):
+                    os.path.getsize(dst_sub_path) \
+                        == os.path.getsize(src_sub_path)
+            os.path.getsize(src_sub_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp(prefix="bench_walk-")
+    try:
+        src = os.path.join(tmp, "src")
+        dst = os.path.join(tmp, "dst")
+        print("Creating {} file(s) in {}...".format(args.files, src))
+        make_tree(src, args.files, size=16)
+        sync_dir(src, dst, status_cb=lambda evt: None)
+
+        with StatCounter() as counter:
+            start = time.time()
+            legacy_size(src)
+            legacy_scan(src, dst)
+            elapsed = time.time() - start
+        print("previous: {} stat call(s) in {:.2f}s"
+              .format(counter.count, elapsed))
+
+        with StatCounter() as counter:
+            start = time.time()
+            event = sync_dir(src, dst, status_cb=lambda evt: None)
+            elapsed = time.time() - start
+        dirs = args.files // 1000 + 1
+        print("walk_tree: about {} DirEntry stat(s) (source entries,"
+              " then only destination files being compared)"
+              " + {} other stat call(s) in {:.2f}s"
+              .format((event['files_total'] + dirs) + event['files_total'],
+                      counter.count, elapsed))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TEST_SUB_DIR = os.path.dirname(os.path.realpath(__file__))
+
+TEST_DATA_DIR = os.path.join(TEST_SUB_DIR, "data")
+
+if __name__ == "__main__":
+    TESTS_DIR = os.path.dirname(TEST_SUB_DIR)
+    REPO_DIR = os.path.dirname(TESTS_DIR)
+    sys.path.insert(0, REPO_DIR)
+
+from backupnow import (  # noqa: E402
+    getRelPaths,
+    sync_dir,
+)
+
+from backupnow.bnmanifest import Manifest  # noqa: E402
+
+
+class TestSyncDir(unittest.TestCase):
+    src = os.path.join(TEST_DATA_DIR, "source1")
+    dst = os.path.join(TEST_DATA_DIR, "destination-sync_dir")
+
+    def setUp(self):
+        if os.path.isdir(self.dst):
+            shutil.rmtree(self.dst)
+        self.events = []
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.isdir(self.dst):
+            shutil.rmtree(self.dst)
+        shutil.rmtree(self.tmp)
+
+    def status_cb(self, event):
+        self.events.append(dict(event))
+
+    def assertSameNames(self, src, dst):
+        self.assertEqual(
+            getRelPaths(src),
+            getRelPaths(dst)
+        )
+
+    def assertCountsIncrease(self):
+        files_done = [event['files_done'] for event in self.events
+                      if 'files_done' in event]
+        self.assertEqual(files_done, sorted(files_done))
+        del self.events[:]
+
+    def check_sync(self, workers):
+        event = sync_dir(self.src, self.dst, status_cb=self.status_cb,
+                         workers=workers)
+        self.assertCountsIncrease()
+        self.assertSameNames(self.src, self.dst)
+        self.assertEqual(event['files_done'], 3)
+        self.assertEqual(event['files_done'], event['files_total'])
+        self.assertEqual(event['bytes_done'], event['bytes_total'])
+        self.assertEqual(event['last_files_total'], 3)
+        # Running again should count every file without copying.
+        event = sync_dir(self.src, self.dst, status_cb=self.status_cb,
+                         workers=workers)
+        self.assertEqual(event['files_done'], 3)
+        self.assertEqual(event['bytes_done'], event['bytes_total'])
+        self.assertCountsIncrease()
+
+    def test_serial(self):
+        self.check_sync(1)
+
+    def test_workers(self):
+        self.check_sync(4)
+
+    def test_manifest(self):
+        manifest_path = os.path.join(self.tmp, "manifest.sqlite3")
+        manifest = Manifest(manifest_path)
+        sync_dir(self.src, self.dst, status_cb=self.status_cb,
+                 manifest=manifest)
+        manifest.close()
+        self.assertSameNames(self.src, self.dst)
+        # The destination is not checked for a file in the manifest:
+        removed = os.path.join(self.dst, "some file with text.txt")
+        os.remove(removed)
+        manifest = Manifest(manifest_path, skip_unchanged_dirs=True)
+        event = sync_dir(self.src, self.dst, status_cb=self.status_cb,
+                         manifest=manifest)
+        manifest.close()
+        self.assertFalse(os.path.exists(removed))
+        self.assertEqual(event['files_done'], 3)
+        self.assertEqual(event['bytes_done'], event['bytes_total'])
+        self.assertEqual(event['manifest_skipped_dirs'], 2)
+        # A new destination is detected, so the manifest is reset:
+        shutil.rmtree(self.dst)
+        manifest = Manifest(manifest_path, skip_unchanged_dirs=True)
+        event = sync_dir(self.src, self.dst, status_cb=self.status_cb,
+                         manifest=manifest)
+        manifest.close()
+        self.assertSameNames(self.src, self.dst)
+        self.assertEqual(event['manifest_skipped_dirs'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()